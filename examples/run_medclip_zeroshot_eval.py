@@ -0,0 +1,138 @@
+import pdb, os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from medclip.modeling_medclip import MedCLIPModel, PromptClassifier, MedCLIPVisionModel
+from medclip.dataset import ZeroShotImageDataset, ZeroShotImageCollator
+from medclip.evaluator import Evaluator
+from medclip import constants
+from medclip.prompts import generate_chexpert_class_prompts, process_class_prompts
+
+# set random seed
+seed = 42
+random.seed(seed)
+np.random.seed(seed)
+torch.manual_seed(seed)
+torch.cuda.manual_seed(seed)
+os.environ['PYTHONASHSEED'] = str(seed)
+os.environ['TOKENIZERS_PARALLELISM']='false'
+
+# set cuda devices
+os.environ['CUDA_VISIBLE_DEVICES']='0'
+device = "cuda:0" if torch.cuda.is_available() else "cpu"
+
+# image batches have a fixed shape, let cudnn pick the fastest conv algorithms.
+# allow tf32 for matmuls and convs running in fp32
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision('high')
+
+# set evaluation configurations
+eval_config = {
+    'batch_size': 128,
+    'num_prompt': 10, # number of prompts sampled for each class
+    'num_repeat': 5, # resample prompts and evaluate for multiple times
+    'ensemble': True,
+    'use_amp': True,
+    'compile': False, # torch.compile the vision encoder, only pays off when encoding many batches
+    'int8': False, # int8 post-training quantization of the vision encoder, evaluate on cpu
+    'checkpoint': './pretrained/medclip-resnet', # downloaded if not exists
+    'img_embeds_cache': None, # if set, save image embeddings to / load them from this .pt file
+}
+# autocast only applies to the gpu path, the int8 model runs on cpu
+use_amp = eval_config['use_amp'] and not eval_config['int8']
+amp_dtype = torch.float16
+if use_amp and torch.cuda.is_bf16_supported(): amp_dtype = torch.bfloat16
+
+# load pretrained medclip model
+model = MedCLIPModel(vision_cls=MedCLIPVisionModel, load_pretrained=False)
+model.from_pretrained(input_dir=eval_config['checkpoint'], map_location='cpu' if eval_config['int8'] else 'cuda')
+model.eval()
+
+# fold batchnorm into convolutions of the resnet
+model.vision_model.fuse_conv_bn()
+
+# zero-shot classification on chexpert-5x200
+val_data = ZeroShotImageDataset(['chexpert-5x200-val'],
+    class_names=constants.CHEXPERT_COMPETITION_TASKS)
+
+# images are encoded once and shared by all repeats, the classifier caches its own prompts
+val_collate_fn = ZeroShotImageCollator(mode='multiclass')
+eval_dataloader = DataLoader(val_data,
+    batch_size=eval_config['batch_size'],
+    collate_fn=val_collate_fn,
+    shuffle=False,
+    pin_memory=True,
+    num_workers=4,
+    prefetch_factor=2,
+    )
+
+if eval_config['int8']:
+    # calibrate and quantize the resnet, the quantized model only runs on cpu
+    model.vision_model.quantize(eval_dataloader, num_calib_batches=4)
+else:
+    model.cuda()
+
+    # use channels_last memory format for the convolutions
+    model.vision_model.to_channels_last()
+
+    # compile the resnet with cuda graphs. images are encoded in a single pass here, so compiling
+    # (plus a recompile for the smaller last batch) costs more than it saves on chexpert-5x200,
+    # enable it for larger datasets. the text encoder only runs once per prompt set and stays eager.
+    if eval_config['compile'] and hasattr(torch, 'compile'):
+        model.vision_model.model = torch.compile(model.vision_model.model, mode='reduce-overhead', fullgraph=True)
+
+evaluator = Evaluator(
+    medclip_clf=None,
+    eval_dataloader=eval_dataloader,
+    mode='multiclass',
+    use_amp=use_amp,
+    amp_dtype=amp_dtype,
+)
+
+# images are the same across repeats, only the prompts are resampled.
+# the cache is only reused if it was built by the same checkpoint and settings
+cache_path = eval_config['img_embeds_cache']
+cache_key = {
+    'checkpoint': os.path.abspath(eval_config['checkpoint']),
+    'checkpoint_mtime': os.path.getmtime(os.path.join(eval_config['checkpoint'], constants.WEIGHTS_NAME)),
+    'int8': eval_config['int8'],
+    'amp_dtype': str(amp_dtype) if use_amp else 'float32',
+    'datalist': 'chexpert-5x200-val',
+}
+cache = None
+if cache_path is not None and os.path.exists(cache_path):
+    cache = torch.load(cache_path, map_location='cpu')
+    if cache['key'] != cache_key:
+        print('image embeddings cache does not match the current settings, encode images again.')
+        cache = None
+if cache is not None:
+    img_embeds, labels = cache['img_embeds'].to(model.logit_scale.device), cache['labels']
+    print('load image embeddings from:', cache_path)
+else:
+    img_embeds, labels = evaluator.encode_images(model)
+    if cache_path is not None:
+        torch.save({'key':cache_key, 'img_embeds':img_embeds, 'labels':labels}, cache_path)
+        print('save image embeddings to:', cache_path)
+
+scores = []
+for i in range(eval_config['num_repeat']):
+    cls_prompts = generate_chexpert_class_prompts(n=eval_config['num_prompt'])
+
+    # the text encoder is frozen, encode class prompts once and compare with all images
+    medclip_clf = PromptClassifier(model,
+        ensemble=eval_config['ensemble'],
+        prompt_inputs=process_class_prompts(cls_prompts),
+        )
+    with torch.inference_mode():
+        pred = medclip_clf.classify_image_embeds(img_embeds)['logits']
+    res = evaluator.compute_metrics(pred.cpu().numpy(), labels.numpy())
+    print(f'repeat {i}: acc {res["acc"]:.4f}')
+    scores.append(res['acc'])
+
+print(f'acc: {np.mean(scores):.4f} +/- {np.std(scores):.4f}')
+print('done')
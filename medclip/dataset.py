@@ -11,7 +11,6 @@ from torch.utils.data import DataLoader, Dataset
 from torch import nn
 from torchvision import transforms
 
-from transformers import AutoTokenizer
 from transformers import CLIPFeatureExtractor, CLIPProcessor
 from transformers.utils import TensorType
 from transformers.feature_extraction_utils import BatchFeature
@@ -25,6 +24,7 @@ from sklearn.preprocessing import OrdinalEncoder
 
 from .prompts import process_class_prompts, process_class_prompts_for_tuning
 from .prompts import generate_chexpert_class_prompts
+from .prompts import get_tokenizer
 from . import constants
 
 class MedCLIPFeatureExtractor(CLIPFeatureExtractor):
@@ -149,8 +149,7 @@ class MedCLIPProcessor(CLIPProcessor):
     tokenizer_class = ("BertTokenizer", "BertTokenizerFast")
     def __init__(self):
         feature_extractor = MedCLIPFeatureExtractor()
-        tokenizer = AutoTokenizer.from_pretrained(constants.BERT_TYPE)
-        tokenizer.model_max_length = 77
+        tokenizer = get_tokenizer()
         super().__init__(feature_extractor, tokenizer)
 
 class ImageTextContrastiveDataset(Dataset):
@@ -332,8 +331,7 @@ class ImageTextContrastiveCollator:
         else:
             self.eda = None
 
-        self.tokenizer = AutoTokenizer.from_pretrained(constants.BERT_TYPE)
-        self.tokenizer.model_max_length = 77
+        self.tokenizer = get_tokenizer()
     def __call__(self, batch):
         inputs = defaultdict(list)
         report_list = []
@@ -418,18 +416,17 @@ class ZeroShotImageDataset(Dataset):
 class ZeroShotImageCollator:
     def __init__(self, mode, cls_prompts=None, n_prompt=5):
         # initialize tokenizer
-        self.tokenizer = AutoTokenizer.from_pretrained(constants.BERT_TYPE)
-        self.tokenizer.model_max_length = 77
+        self.tokenizer = get_tokenizer()
         assert mode in ['multiclass','multilabel','binary']
         self.mode = mode
 
-        if cls_prompts is None:
-            raise NotImplementedError
-        else:
-            self.cls_prompts = cls_prompts
+        # cls_prompts can be None if only images are needed, e.g., the classifier caches its own prompts
+        self.cls_prompts = cls_prompts
 
         # process cls prompts into texts indices
-        self.prompt_texts_inputs = process_class_prompts(self.cls_prompts)
+        self.prompt_texts_inputs = None
+        if self.cls_prompts is not None:
+            self.prompt_texts_inputs = process_class_prompts(self.cls_prompts)
 
     def __call__(self, batch):
         inputs = defaultdict(list)
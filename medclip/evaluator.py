@@ -19,15 +19,20 @@ class Evaluator:
         medclip_clf,
         eval_dataloader=None,
         mode=None,
+        use_amp=False,
+        amp_dtype=torch.float16,
         ) -> None:
         '''specify class_names if doing zero-shot classification.
         mode: `binary`, 'multiclass`, or `multilabel`,
         if set None, the method will automatically decide from data.
         recommend to set explicitly to avoid errors.
+        use_amp: run the forward under autocast with `amp_dtype` (float16 or bfloat16).
         '''
         self.clf = medclip_clf
         self.mode = mode
         self.eval_dataloader = eval_dataloader
+        self.use_amp = use_amp
+        self.amp_dtype = amp_dtype
     
     def evaluate(self, eval_dataloader=None):
         self.clf.eval()
@@ -35,10 +40,10 @@ class Evaluator:
         else: eval_dataloader = self.eval_dataloader
         pred_list = []
         label_list = []
-        for data in tqdm(eval_dataloader, desc='Evaluation'):
-            with torch.no_grad():
+        for data in tqdm(self._prefetch(eval_dataloader, self.clf), desc='Evaluation', total=len(eval_dataloader)):
+            with torch.inference_mode(), torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.use_amp):
                 outputs = self.clf(**data)
-                pred = outputs['logits']
+                pred = outputs['logits'].float()
             pred_list.append(pred)
             label_list.append(data['labels'])
         
@@ -46,6 +51,28 @@ class Evaluator:
         labels = torch.cat(label_list, 0).cpu().detach().numpy()
 
         pred = pred_list.cpu().detach().numpy()        
+        return self.compute_metrics(pred, labels)
+
+    def encode_images(self, medclip_model, eval_dataloader=None):
+        '''encode all images in the dataloader once by `medclip_model.encode_image`,
+        the embeddings can be reused by `PromptClassifier.classify_image_embeds` with different prompts.
+        returns image embeddings and labels.
+        '''
+        medclip_model.eval()
+        if eval_dataloader is None: eval_dataloader = self.eval_dataloader
+        img_embeds_list = []
+        label_list = []
+        for data in tqdm(self._prefetch(eval_dataloader, medclip_model), desc='Encode images', total=len(eval_dataloader)):
+            with torch.inference_mode(), torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.use_amp):
+                img_embeds = medclip_model.encode_image(data['pixel_values']).float()
+            img_embeds_list.append(img_embeds)
+            label_list.append(data['labels'])
+        return torch.cat(img_embeds_list, 0), torch.cat(label_list, 0).cpu()
+
+    def compute_metrics(self, pred, labels):
+        '''compute metrics from predicted logits and labels (numpy arrays),
+        useful when the predictions are made outside `evaluate`.
+        '''
         outputs = {'pred':pred, 'labels':labels}
 
         if self.mode is None:
@@ -109,6 +136,28 @@ class Evaluator:
             outputs['auprc'] = np.mean(auprc_list)
         return outputs
     
+    def _prefetch(self, eval_dataloader, model):
+        '''copy the next batch to gpu on a side stream while the current batch is being computed by `model`.
+        '''
+        if not torch.cuda.is_available() or not next(model.parameters()).is_cuda:
+            yield from eval_dataloader
+            return
+
+        stream = torch.cuda.Stream()
+        batch = None
+        for data in eval_dataloader:
+            with torch.cuda.stream(stream):
+                data = {k: v.cuda(non_blocking=True) if torch.is_tensor(v) else v for k, v in data.items()}
+            if batch is not None:
+                yield batch
+            # wait for the copy, and keep the copied tensors alive until the computing stream is done with them
+            torch.cuda.current_stream().wait_stream(stream)
+            for v in data.values():
+                if torch.is_tensor(v): v.record_stream(torch.cuda.current_stream())
+            batch = data
+        if batch is not None:
+            yield batch
+
     def process_confusion_matrix(self, cnf_matrix):
         FP = cnf_matrix.sum(axis=0) - np.diag(cnf_matrix) 
         FN = cnf_matrix.sum(axis=1) - np.diag(cnf_matrix)
@@ -6,11 +6,13 @@ import requests
 
 import torch
 from torch import nn
-from transformers import AutoModel, AutoTokenizer
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from transformers import AutoModel, AutoConfig
 import numpy as np
 import torchvision
 
 from . import constants
+from .prompts import get_tokenizer
 
 class MedCLIPTextModel(nn.Module):
     def __init__(self,
@@ -21,8 +23,8 @@ class MedCLIPTextModel(nn.Module):
         self.bert_type = bert_type
         self.last_n_layer = 4
         self.model = AutoModel.from_pretrained(self.bert_type, output_hidden_states=True)
-        # this tokenizer is actually not used
-        self.tokenizer = AutoTokenizer.from_pretrained(self.bert_type)
+        # this tokenizer is actually not used, it is the shared one truncating texts at 77 tokens
+        self.tokenizer = get_tokenizer(self.bert_type)
         self.projection_head = nn.Linear(768, proj_dim, bias=proj_bias)
 
     def forward(self, input_ids, attention_mask):
@@ -46,11 +48,17 @@ class MedCLIPVisionModel(nn.Module):
     '''
     take resnet50 as backbone.
     '''
-    def __init__(self, checkpoint=None, medclip_checkpoint=None):
+    def __init__(self, checkpoint=None, medclip_checkpoint=None, load_pretrained=True):
+        '''args:
+        checkpoint: load from the vision encoder checkpoint
+        medclip_checkpoint: load from the vision-text dual encoders checkpoint
+        load_pretrained: initialize resnet50 from imagenet weights, set False if the weights will be overwritten anyway
+        '''
         super().__init__()
-        self.model = torchvision.models.resnet50(pretrained=True)
+        self.model = torchvision.models.resnet50(pretrained=load_pretrained)
         num_fts = self.model.fc.in_features
         self.model.fc = nn.Linear(num_fts, 512, bias=False) # projection head
+        self.channels_last = False
         if checkpoint is not None:
             state_dict = torch.load(os.path.join(checkpoint, constants.WEIGHTS_NAME))
             missing_keys, unexpected_keys = self.load_state_dict(state_dict, strict=False)
@@ -73,25 +81,84 @@ class MedCLIPVisionModel(nn.Module):
         print('unexpected keys:', unexpected_keys)
         print('load model weight from:', checkpoint)
 
+    def fuse_conv_bn(self):
+        '''fold the batchnorm layers of resnet into their preceding convolutions.
+        only for inference: the fused model can not be trained anymore.
+        '''
+        assert not self.training, 'call `model.eval()` before fusing conv and bn.'
+        resnet = self.model
+        resnet.conv1 = fuse_conv_bn_eval(resnet.conv1, resnet.bn1)
+        resnet.bn1 = nn.Identity()
+        for layer in [resnet.layer1, resnet.layer2, resnet.layer3, resnet.layer4]:
+            for block in layer:
+                i = 1
+                while hasattr(block, f'conv{i}'):
+                    setattr(block, f'conv{i}', fuse_conv_bn_eval(getattr(block, f'conv{i}'), getattr(block, f'bn{i}')))
+                    setattr(block, f'bn{i}', nn.Identity())
+                    i += 1
+                if block.downsample is not None:
+                    block.downsample[0] = fuse_conv_bn_eval(block.downsample[0], block.downsample[1])
+                    block.downsample[1] = nn.Identity()
+        return self
+
+    def quantize(self, calib_dataloader, num_calib_batches=10):
+        '''int8 post-training static quantization of resnet by fx graph mode.
+        the quantized model runs on cpu only (fbgemm backend).
+        calib_dataloader: yields dicts with `pixel_values` used to calibrate activation ranges.
+        num_calib_batches: number of batches used for calibration.
+        '''
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        assert not self.training, 'call `model.eval()` before quantization.'
+        assert not self.channels_last, 'quantize before converting to channels_last.'
+        self.cpu()
+        example_inputs = None
+        for i, data in enumerate(calib_dataloader):
+            if i >= num_calib_batches: break
+            pixel_values = data['pixel_values'].cpu()
+            if pixel_values.shape[1] == 1: pixel_values = pixel_values.repeat((1,3,1,1))
+            if example_inputs is None:
+                example_inputs = (pixel_values,)
+                prepared = prepare_fx(self.model, get_default_qconfig_mapping('fbgemm'), example_inputs)
+            with torch.no_grad():
+                prepared(pixel_values)
+        if example_inputs is None:
+            raise ValueError('Got no batch from `calib_dataloader` for calibration, check the dataloader and `num_calib_batches` > 0.')
+        self.model = convert_fx(prepared)
+        return self
+
+    def to_channels_last(self):
+        '''convert resnet weights and input images to channels_last (NHWC) memory format,
+        which is faster for convolutions on tensor cores, especially with fp16/bf16.
+        '''
+        self.model = self.model.to(memory_format=torch.channels_last)
+        self.channels_last = True
+        return self
+
     def forward(self, pixel_values, **kwargs):
         '''args:
         pixel_values: tensor with shape [bs, 3, img_size, img_size]
         '''
         if pixel_values.shape[1] == 1: pixel_values = pixel_values.repeat((1,3,1,1))
+        if self.channels_last: pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
         img_embeds = self.model(pixel_values)
         return img_embeds
 
 class MedCLIPVisionModelViT(nn.Module):
     '''take an VIT model as the backbone.
     '''
-    def __init__(self, checkpoint=None, medclip_checkpoint=None) -> None:
+    def __init__(self, checkpoint=None, medclip_checkpoint=None, load_pretrained=True) -> None:
         '''args:
         checkpoint: load from the vision encoder checkpoint
         medclip_checkpoint: load from the vision-text dual encoders checkpoint
+        load_pretrained: initialize swin from pretrained weights, set False if the weights will be overwritten anyway
         '''
         super().__init__()
         self.vit_type = constants.VIT_TYPE
-        self.model = AutoModel.from_pretrained(self.vit_type)
+        if load_pretrained:
+            self.model = AutoModel.from_pretrained(self.vit_type)
+        else:
+            self.model = AutoModel.from_config(AutoConfig.from_pretrained(self.vit_type))
         self.projection_head = nn.Linear(768, 512, bias=False)
         if checkpoint is not None:
             state_dict = torch.load(os.path.join(checkpoint, constants.WEIGHTS_NAME))
@@ -132,25 +199,35 @@ class MedCLIPModel(nn.Module):
         checkpoint=None,
         vision_checkpoint=None,
         logit_scale_init_value=0.07,
+        load_pretrained=True,
         ) -> None:
+        '''args:
+        load_pretrained: initialize the vision encoder from imagenet pretrained weights,
+            set False when loading medclip weights by `checkpoint` or `from_pretrained` afterwards.
+        '''
         super().__init__()
         text_proj_bias = False
         assert vision_cls in [MedCLIPVisionModel, MedCLIPVisionModelViT], 'vision_cls should be one of [MedCLIPVisionModel, MedCLIPVisionModelViT]'
 
-        self.vision_model = vision_cls(checkpoint=vision_checkpoint)
+        self.vision_model = vision_cls(checkpoint=vision_checkpoint, load_pretrained=load_pretrained)
         self.text_model = MedCLIPTextModel(proj_bias=False)
 
         # learnable temperature for contrastive loss
         self.logit_scale = nn.Parameter(torch.log(torch.tensor(1/logit_scale_init_value)))
 
+        # cached targets [0, 1, ..., bs-1] of the contrastive loss, grows with the batch size
+        self.register_buffer('contrastive_targets', torch.arange(0), persistent=False)
+
         if checkpoint is not None:
-            state_dict = torch.load(os.path.join(checkpoint, constants.WEIGHTS_NAME))
-            self.load_state_dict(state_dict)
+            state_dict = torch.load(os.path.join(checkpoint, constants.WEIGHTS_NAME), map_location='cpu', mmap=True)
+            self.load_state_dict(state_dict, assign=True)
             print('load model weight from:', checkpoint)
 
-    def from_pretrained(self, input_dir=None):
+    def from_pretrained(self, input_dir=None, map_location=None):
         '''
         If input_dir is None, download pretrained weight from google cloud and load.
+        map_location: if None, copy weights into the current parameters, keeping their device and dtype.
+            otherwise load weights onto this device (e.g., `cuda`) and take them as the parameters directly.
         '''
         import wget
         import zipfile
@@ -181,22 +258,26 @@ class MedCLIPModel(nn.Module):
             zipf.close()
             print('\n Download pretrained model from:', pretrained_url)
         
-        state_dict = torch.load(os.path.join(input_dir, constants.WEIGHTS_NAME))
-        self.load_state_dict(state_dict)
+        # mmap the checkpoint. if map_location is given, take its tensors as parameters instead of copying them
+        state_dict = torch.load(os.path.join(input_dir, constants.WEIGHTS_NAME),
+            map_location='cpu' if map_location is None else map_location, mmap=True)
+        self.load_state_dict(state_dict, assign=map_location is not None)
         print('load model weight from:', input_dir)
 
     def encode_text(self, input_ids=None, attention_mask=None):
-        input_ids = input_ids.cuda()
+        # no-op if the inputs are already on the model device, e.g., moved by a prefetcher
+        input_ids = input_ids.to(self.logit_scale.device, non_blocking=True)
         if attention_mask is not None:
-            attention_mask = attention_mask.cuda()
+            attention_mask = attention_mask.to(self.logit_scale.device, non_blocking=True)
         text_embeds = self.text_model(input_ids, attention_mask)
-        text_embeds = text_embeds / text_embeds.norm(dim=-1, keepdim=True)
+        text_embeds = nn.functional.normalize(text_embeds, dim=-1)
         return text_embeds
 
     def encode_image(self, pixel_values=None):
         # image encoder
+        pixel_values = pixel_values.to(self.logit_scale.device, non_blocking=True)
         vision_output = self.vision_model(pixel_values=pixel_values)
-        img_embeds = vision_output / vision_output.norm(dim=-1, keepdim=True)
+        img_embeds = nn.functional.normalize(vision_output, dim=-1)
         return img_embeds
 
     def forward(self,
@@ -206,27 +287,23 @@ class MedCLIPModel(nn.Module):
         return_loss=None,
         **kwargs,
         ):
-        input_ids = input_ids.cuda()
-        if attention_mask is not None:
-            attention_mask = attention_mask.cuda()
-        pixel_values = pixel_values.cuda()
-
         img_embeds = self.encode_image(pixel_values)
         text_embeds = self.encode_text(input_ids, attention_mask)
 
         logits_per_image = self.compute_logits(img_embeds, text_embeds)
-        logits_per_text = logits_per_image.t()
+        outputs = {'img_embeds':img_embeds, 'text_embeds':text_embeds, 'logits':logits_per_image}
 
+        # only build the text-side logits and loss when training with the clip loss
         if return_loss:
-            loss = self.clip_loss(logits_per_text)
-        else:
-            loss = None
+            logits_per_text = logits_per_image.t()
+            outputs['loss_value'] = self.clip_loss(logits_per_text)
+            outputs['logits_per_text'] = logits_per_text
 
-        return {'img_embeds':img_embeds, 'text_embeds':text_embeds,
-            'logits':logits_per_image, 'loss_value':loss, 'logits_per_text':logits_per_text}
+        return outputs
 
     def compute_logits(self, img_emb, text_emb):
-        self.logit_scale.data = torch.clamp(self.logit_scale.data, 0, 4.6052)
+        # clamp in-place, a new tensor would be an inference tensor when called under torch.inference_mode
+        self.logit_scale.data.clamp_(0, 4.6052)
         logit_scale = self.logit_scale.exp()
         logits_per_text = torch.matmul(text_emb, img_emb.t()) * logit_scale
         return logits_per_text.t()
@@ -237,31 +314,77 @@ class MedCLIPModel(nn.Module):
         return (caption_loss + image_loss) / 2.0
 
     def contrastive_loss(self, logits: torch.Tensor) -> torch.Tensor:
-        return nn.functional.cross_entropy(logits, torch.arange(len(logits), device=logits.device))
+        targets = self.contrastive_targets
+        if len(targets) < len(logits) or targets.device != logits.device \
+            or (targets.is_inference() and not torch.is_inference_mode_enabled()):
+            # build outside inference mode, an inference tensor can not be saved for backward in later training steps
+            with torch.inference_mode(False):
+                self.contrastive_targets = torch.arange(len(logits), device=logits.device)
+        return nn.functional.cross_entropy(logits, self.contrastive_targets[:len(logits)])
 
 class PromptClassifier(nn.Module):
     '''take MedCLIP model with prompts for zero-shot classification
     '''
-    def __init__(self, medclip_model, ensemble=False, **kwargs) -> None:
+    def __init__(self, medclip_model, ensemble=False, prompt_inputs=None, **kwargs) -> None:
+        '''args:
+        medclip_model: the medclip model used to encode images and prompts.
+        ensemble: take the mean over prompts as the class similarity if True, otherwise take the max.
+        prompt_inputs: if given, encode the class prompts once here and reuse the text embeddings
+            for every batch, the passed `prompt_inputs` in `forward` will be ignored.
+            only use it when the text encoder is frozen, e.g., for evaluation.
+        '''
         super().__init__()
         self.model = medclip_model
         self.ensemble = ensemble
+        self.register_buffer('text_embeds', None, persistent=False)
+        self.register_buffer('text_mask', None, persistent=False)
+        if prompt_inputs is not None:
+            # encode in eval mode so that dropout is not baked into the cached embeddings
+            text_model_training = self.model.text_model.training
+            self.model.text_model.eval()
+            with torch.no_grad():
+                cls_text_embeds = self.encode_prompts(prompt_inputs)
+            self.model.text_model.train(text_model_training)
+
+            # pad prompts of all classes into [n_class, max_n_prompt, emb_dim] to classify in one pass,
+            # text_mask marks the valid prompts of each class
+            self.class_names = list(cls_text_embeds.keys())
+            max_n_prompt = max(len(v) for v in cls_text_embeds.values())
+            first = next(iter(cls_text_embeds.values()))
+            text_embeds = first.new_zeros(len(cls_text_embeds), max_n_prompt, first.shape[-1])
+            text_mask = torch.zeros(len(cls_text_embeds), max_n_prompt, dtype=torch.bool, device=first.device)
+            for i, cls_embeds in enumerate(cls_text_embeds.values()):
+                text_embeds[i, :len(cls_embeds)] = cls_embeds
+                text_mask[i, :len(cls_embeds)] = True
+            self.text_embeds = text_embeds
+            self.text_mask = text_mask
+
+    def encode_prompts(self, prompt_inputs):
+        '''encode prompt_inputs into a dict of {'class1': text_embeds, 'class2':...},
+        each with shape [n_prompt, emb_dim].
+        '''
+        text_embeds = {}
+        for cls_name, cls_text in prompt_inputs.items():
+            text_embeds[cls_name] = self.model.encode_text(cls_text['input_ids'], cls_text.get('attention_mask'))
+        return text_embeds
 
     def forward(self, pixel_values=None, prompt_inputs=None, **kwargs):
         '''take image pixel values (after transform) and prompt_inputs
         (a dict of {'class1':{'input_ids':...,'attention_mask':,...}), 'class2':...}
         '''
-        pixel_values = pixel_values.cuda()
+        pixel_values = pixel_values.to(self.model.logit_scale.device, non_blocking=True)
+        if self.text_embeds is not None:
+            return self.classify_image_embeds(self.model.encode_image(pixel_values))
+
         class_similarities = []
         class_names = []
+        # images are the same for all classes, only encode them once
+        img_embeds = self.model.encode_image(pixel_values)
         for cls_name, cls_text in prompt_inputs.items():
-            inputs = {'pixel_values':pixel_values}
-            for k in cls_text.keys(): inputs[k] = cls_text[k].cuda()
-
             # TODO:
             # take soft mask over class_prompts to reach the similarities to classes
-            medclip_outputs = self.model(**inputs)
-            logits = medclip_outputs['logits']
+            text_embeds = self.model.encode_text(cls_text['input_ids'], cls_text.get('attention_mask'))
+            logits = self.model.compute_logits(img_embeds, text_embeds)
 
             # take logits max as the class similarity
             # cls_sim = torch.max(logits, 1)[0] # equivalent use only one prompt
@@ -279,6 +402,26 @@ class PromptClassifier(nn.Module):
         }
         return outputs
 
+    def classify_image_embeds(self, img_embeds):
+        '''compare normalized image embeddings (from `medclip_model.encode_image`) with the cached prompt embeddings.
+        image embeddings can be precomputed and reused across prompt sets.
+        '''
+        assert self.text_embeds is not None, 'pass `prompt_inputs` when building the classifier to cache prompt embeddings.'
+        n_class, max_n_prompt = self.text_mask.shape
+        logits = self.model.compute_logits(img_embeds, self.text_embeds.flatten(0, 1))
+        logits = logits.view(-1, n_class, max_n_prompt) # bs, n_class, max_n_prompt
+        if self.ensemble:
+            # equivalent to prompt ensembling
+            class_similarities = logits.masked_fill(~self.text_mask, 0).sum(-1) / self.text_mask.sum(-1)
+        else:
+            class_similarities = logits.masked_fill(~self.text_mask, float('-inf')).max(-1)[0]
+
+        outputs = {
+            'logits': class_similarities,
+            'class_names': self.class_names,
+        }
+        return outputs
+
 class SuperviseClassifier(nn.Module):
     '''take MedCLIP model with linear heads for supervised classification on images.
     '''
@@ -317,14 +460,14 @@ class SuperviseClassifier(nn.Module):
         **kwargs,
         ):
         outputs = defaultdict()
-        pixel_values = pixel_values.cuda()
+        pixel_values = pixel_values.to(self.fc.weight.device, non_blocking=True)
         # take embeddings before the projection head
         img_embeds = self.model(pixel_values, project=False)
         logits = self.fc(img_embeds)
         outputs['embedding'] = img_embeds
         outputs['logits'] = logits
         if labels is not None and return_loss:
-            labels = labels.cuda().float()
+            labels = labels.to(logits.device, non_blocking=True).float()
             if len(labels.shape) == 1: labels = labels.view(-1,1)
             if self.mode == 'multiclass': labels = labels.flatten().long()
             loss = self.loss_fn(logits, labels)
@@ -401,17 +544,16 @@ class PromptTuningClassifier(nn.Module):
         '''take image pixel values (after transform) and prompt_inputs
         (a dict of {'class1':{'input_ids':...,'attention_mask':,...}), 'class2':...}
         '''
-        pixel_values = pixel_values.cuda()
+        pixel_values = pixel_values.to(self.model.logit_scale.device, non_blocking=True)
         class_similarities = []
         class_names = []
+        # images are the same for all classes, only encode them once
+        img_embeds = self.model.encode_image(pixel_values)
         for cls_name, cls_text in prompt_inputs.items():
-            inputs = {'pixel_values':pixel_values}
-            for k in cls_text.keys(): inputs[k] = cls_text[k].cuda()
-
             # TODO:
             # take soft mask over class_prompts to reach the similarities to classes
-            medclip_outputs = self.model(**inputs)
-            logits = medclip_outputs['logits']
+            text_embeds = self.model.encode_text(cls_text['input_ids'], cls_text.get('attention_mask'))
+            logits = self.model.compute_logits(img_embeds, text_embeds)
 
             # take logits max as the class similarity
             # cls_sim = torch.max(logits, 1)[0] # equivalent use only one prompt
@@ -429,7 +571,7 @@ class PromptTuningClassifier(nn.Module):
         }
 
         if labels is not None and return_loss:
-            labels = labels.cuda().float()
+            labels = labels.to(class_similarities.device, non_blocking=True).float()
             if len(labels.shape) == 1: labels = labels.view(-1,1)
             if self.mode in ['multiclass', 'binary']: labels = labels.flatten().long()
             loss = self.loss_fn(class_similarities, labels)
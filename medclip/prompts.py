@@ -1,11 +1,29 @@
 import random
 import pdb
+import math
+import functools
+import itertools
 from collections import defaultdict
 
+import numpy as np
 from transformers import AutoTokenizer
 
 from . import constants
 
+def get_tokenizer(bert_type=None):
+    '''load the tokenizer once and share it across prompts, collators, processors and models.
+    texts are truncated to 77 tokens. do not add tokens to the shared tokenizer,
+    use a new instance instead (see `process_class_prompts_for_tuning`).
+    '''
+    # resolve the default here, lru_cache keys on the arguments as passed
+    return _load_tokenizer(constants.BERT_TYPE if bert_type is None else bert_type)
+
+@functools.lru_cache(maxsize=None)
+def _load_tokenizer(bert_type):
+    tokenizer = AutoTokenizer.from_pretrained(bert_type)
+    tokenizer.model_max_length = 77
+    return tokenizer
+
 def generate_class_prompts(df_sent, task=None, n=100):
     '''args:
     df_sent: pd.DataFrame with sentence labels, columns=['Reports', 'task1', 'task2',...]
@@ -24,9 +42,13 @@ def generate_class_prompts(df_sent, task=None, n=100):
     else:
         target_tasks = all_tasks
 
+    # a sentence is kept for a task if it is positive for the task and mentions no other task,
+    # i.e., the only nonzero label is the task
+    labels = df_sent[all_tasks].to_numpy()
+    num_nonzero = (labels != 0).sum(1)
     for task in target_tasks:
-        other_tasks = [t for t in all_tasks if t != task]
-        df_sub_sent = df_sent[(df_sent[task] == 1) & (df_sent[other_tasks] == 0).all(1)]
+        mask = (labels[:, all_tasks.index(task)] == 1) & (num_nonzero == 1)
+        df_sub_sent = df_sent.iloc[np.where(mask)[0]]
         if n is not None:
             if len(df_sub_sent) > n: df_sub_sent = df_sub_sent.sample(n)
         prompts[task] = df_sub_sent['Reports'].values.tolist()
@@ -46,68 +68,53 @@ def generate_chexpert_class_prompts(n = None):
 
     prompts = {}
     for k, v in constants.CHEXPERT_CLASS_PROMPTS.items():
-        cls_prompts = []
-        keys = list(v.keys())
-
-        # severity
-        for k0 in v[keys[0]]:
-            # subtype
-            for k1 in v[keys[1]]:
-                # location
-                for k2 in v[keys[2]]:
-                    cls_prompts.append(f"{k0} {k1} {k2}")
-
         # randomly sample n prompts for zero-shot classification
         # TODO: we shall make use all the candidate prompts for autoprompt tuning
-        if n is not None and n < len(cls_prompts):
-            prompts[k] = random.sample(cls_prompts, n)
-        else:
-            prompts[k] = cls_prompts
-        print(f'sample {len(prompts[k])} num of prompts for {k} from total {len(cls_prompts)}')
+        prompts[k], total = _sample_prompt_combinations(v, n)
+        print(f'sample {len(prompts[k])} num of prompts for {k} from total {total}')
     return prompts
 
 def generate_covid_class_prompts(n = None):
     prompts = {}
     for k, v in constants.COVID_CLASS_PROMPTS.items():
-        cls_prompts = []
-        keys = list(v.keys())
-
-        for k0 in v[keys[0]]:
-            for k1 in v[keys[1]]:
-                for k2 in v[keys[2]]:
-                    for k3 in v[keys[3]]:
-                        cls_prompts.append(f"{k0} {k1} {k2} {k3}")
-
         # randomly sample n prompts for zero-shot classification
-        if n is not None and n < len(cls_prompts):
-            prompts[k] = random.sample(cls_prompts, n)
-        else:
-            prompts[k] = cls_prompts
-        print(f'sample {len(prompts[k])} num of prompts for {k} from total {len(cls_prompts)}')
+        prompts[k], total = _sample_prompt_combinations(v, n)
+        print(f'sample {len(prompts[k])} num of prompts for {k} from total {total}')
     return prompts
 
 def generate_rsna_class_prompts(n = None):
     prompts = {}
     for k, v in constants.RSNA_CLASS_PROMPTS.items():
-        cls_prompts = []
-        keys = list(v.keys())
-
-        for k0 in v[keys[0]]:
-            for k1 in v[keys[1]]:
-                for k2 in v[keys[2]]:
-                    cls_prompts.append(f"{k0} {k1} {k2}")
-
         # randomly sample n prompts for zero-shot classification
-        if n is not None and n < len(cls_prompts):
-            prompts[k] = random.sample(cls_prompts, n)
-        else:
-            prompts[k] = cls_prompts
-        print(f'sample {len(prompts[k])} num of prompts for {k} from total {len(cls_prompts)}')
+        prompts[k], total = _sample_prompt_combinations(v, n)
+        print(f'sample {len(prompts[k])} num of prompts for {k} from total {total}')
     return prompts
 
+def _sample_prompt_combinations(cls_prompt_attrs, n=None):
+    '''sample n combinations of the prompt attributes, e.g., {'severity':[...], 'subtype':[...], 'location':[...]},
+    only the sampled combinations are formatted into sentences. take all combinations if n is None.
+    returns the prompts and the total number of combinations.
+    '''
+    attrs = list(cls_prompt_attrs.values())
+    total = math.prod(len(a) for a in attrs)
+    if n is not None and n < total:
+        # decode each sampled index into one choice per attribute, in the order of itertools.product.
+        # random.sample only depends on the population size, so for a fixed seed this picks
+        # the same prompts as sampling from the full list of combinations.
+        combinations = []
+        for index in random.sample(range(total), n):
+            combination = []
+            for a in reversed(attrs):
+                index, i = divmod(index, len(a))
+                combination.append(a[i])
+            combinations.append(combination[::-1])
+    else:
+        combinations = itertools.product(*attrs)
+    prompts = [' '.join(c) for c in combinations]
+    return prompts, total
+
 def process_class_prompts(cls_prompts):
-    tokenizer = AutoTokenizer.from_pretrained(constants.BERT_TYPE)
-    tokenizer.model_max_length = 77
+    tokenizer = get_tokenizer()
     cls_prompt_inputs = defaultdict()
     for k,v in cls_prompts.items():
         text_inputs = tokenizer(v, truncation=True, padding=True, return_tensors='pt')